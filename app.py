@@ -1,15 +1,19 @@
+import gc
 import os
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 
 import streamlit as st
 from PIL import Image
 from pypdf import PdfReader, PdfWriter
+from pypdf.generic import ContentStream, DictionaryObject, IndirectObject, NameObject
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import A4, landscape
 from reportlab.lib.units import cm
 from reportlab.lib.utils import ImageReader, simpleSplit
+from reportlab.pdfbase.pdfmetrics import getFont, unicode2T1
 
 # --- Rutas de activos ---
 ASSETS_DIR = "assets"
@@ -24,6 +28,18 @@ EXPLANATION_PARA = (
     "y facilitar la verificación de las condiciones de seguridad establecidas."
 )
 
+# Resolución máxima de las imágenes de anexo: A4 horizontal completo a 150 ppp (el recuadro real es menor)
+ANNEX_DPI = 150
+ANNEX_MAX_PX = (int(landscape(A4)[0] / 72 * ANNEX_DPI), int(landscape(A4)[1] / 72 * ANNEX_DPI))
+
+# Fuentes estándar con las que se pintan los valores sobre la plantilla -> nombre del recurso en la página
+# (Helvetica y sus fuentes de sustitución en ReportLab, para caracteres fuera de WinAnsi como ≥, ≤ o Ω)
+OVERLAY_FONTS = {
+    "Helvetica": "/FEspHelv",
+    "Symbol": "/FEspSymb",
+    "ZapfDingbats": "/FEspZapf",
+}
+
 # ----- Etiquetas amigables para campos conocidos (si alguno falta, se muestra tal cual viene del PDF) -----
 FIELD_TITLES = {
     "Text1": "Obra / Proyecto",
@@ -63,36 +79,83 @@ FIELD_TITLES = {
 }
 
 # ------------- Utilidades PDF -------------
-def _page_size(page):
-    mb = page.mediabox
-    return float(mb.right) - float(mb.left), float(mb.top) - float(mb.bottom)
-
-def _draw_values_overlay(fields_on_page, page_w, page_h):
+def _field_layout(rect: List[float]):
     """
-    Crea un PDF de una página con los textos posicionados en las coordenadas de cada campo.
+    Calcula (tamaño de fuente, x, y) del texto de un campo a partir de su rectángulo.
     Aproxima tamaño de fuente al alto del recuadro (+ alineación izquierda).
     """
-    buf = BytesIO()
-    can = canvas.Canvas(buf, pagesize=(page_w, page_h))
-    for f in fields_on_page:
+    x1, y1, x2, y2 = rect
+    font_size = min(10.5, max(8.0, (y2 - y1) * 0.50))  # aproximación visual
+    return font_size, x1 + 2, y1 + (y2 - y1 - font_size) / 2  # centrado vertical suave
+
+_HELVETICA = getFont("Helvetica")
+
+def _pdf_runs(text: str) -> List[Tuple[str, bytes]]:
+    """
+    Parte un texto en tramos (recurso de fuente, literal de cadena PDF) igual que drawString de ReportLab:
+    Helvetica en WinAnsi y Symbol/ZapfDingbats para lo que no cabe (≥, ≤, Ω...). Lo que ninguna cubre
+    sale con el glifo de sustitución de ReportLab (un cuadrado), como en el canvas. Escapa \\, ( y ).
+    """
+    runs = []
+    for font, raw in unicode2T1(text, [_HELVETICA] + _HELVETICA.substitutionFonts):
+        literal = b"(" + raw.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)") + b")"
+        runs.append((OVERLAY_FONTS[font.fontName], literal))
+    return runs
+
+def _values_content_stream(fields_on_page: List[Dict]) -> bytes:
+    """
+    Genera los operadores PDF que pintan los textos en las coordenadas de cada campo.
+    Usa la disposición precalculada en extract_fields; agrupa por tamaño para emitir un Tf por grupo
+    (y otro solo cuando un tramo cambia de fuente).
+    """
+    ops = [b"q BT 0 g"]
+    prev_font = None
+    for f in sorted(fields_on_page, key=lambda f: f["_font_size"]):
         val = f.get("value", "")
         if not val:
             continue
-        x1, y1, x2, y2 = f["rect"]
-        text = str(val).strip("()")
-        font_size = min(10.5, max(8.0, (y2 - y1) * 0.50))  # aproximación visual
-        can.setFont("Helvetica", font_size)               # misma familia 'neutra' y limpia
-        can.setFillGray(0.0)
-        can.drawString(x1 + 2, y1 + (y2 - y1 - font_size) / 2, text)  # centrado vertical suave
-    can.save()
-    buf.seek(0)
-    return PdfReader(buf)
+        font_size = f["_font_size"]
+        ops.append(b"1 0 0 1 %.2f %.2f Tm" % (f["_draw_x"], f["_draw_y"]))
+        for font_res, literal in _pdf_runs(str(val).strip("()")):
+            if (font_res, font_size) != prev_font:
+                ops.append(b"%s %.2f Tf" % (font_res.encode(), font_size))  # misma familia 'neutra' y limpia
+                prev_font = (font_res, font_size)
+            ops.append(literal + b" Tj")
+    ops.append(b"ET Q")
+    return b"\n".join(ops)
 
-def flatten_template_with_values(template_bytes: bytes, fields: List[Dict]) -> PdfWriter:
+def _ensure_overlay_fonts(page):
+    """
+    Registra las fuentes de OVERLAY_FONTS en los recursos de la página (Helvetica en WinAnsi,
+    Symbol y ZapfDingbats con su codificación propia).
+    """
+    resources = page.get(NameObject("/Resources"))
+    if resources is None:
+        resources = page[NameObject("/Resources")] = DictionaryObject()
+    resources = resources.get_object()
+    fonts = resources.get(NameObject("/Font"))
+    if fonts is None:
+        fonts = resources[NameObject("/Font")] = DictionaryObject()
+    fonts = fonts.get_object()
+    for base_font, res_name in OVERLAY_FONTS.items():
+        font = DictionaryObject({
+            NameObject("/Type"): NameObject("/Font"),
+            NameObject("/Subtype"): NameObject("/Type1"),
+            NameObject("/BaseFont"): NameObject("/" + base_font),
+        })
+        if base_font == "Helvetica":
+            font[NameObject("/Encoding")] = NameObject("/WinAnsiEncoding")
+        fonts[NameObject(res_name)] = font
+
+def flatten_template_with_values(reader: PdfReader, fields: List[Dict]) -> PdfWriter:
     """
     Aplana la plantilla en memoria con los valores y elimina los formularios.
+    Los textos se añaden directamente al flujo de contenido de cada página (sin canvas ni merge_page).
+    No se usa update_page_form_field_values: la fuente del /DA (/F0 en /AcroForm /DR) es Helvetica
+    estándar /Type1 sin /Encoding ni incrustar, y pypdf 4.3 recurre entonces a la codificación "charmap":
+    escribe códigos hex de 2 bytes y deja los escapes \\( \\) dentro de la cadena hex, así que las
+    apariencias salen con caracteres erróneos (tildes, ñ, paréntesis).
     """
-    reader = PdfReader(BytesIO(template_bytes))
     writer = PdfWriter()
 
     # Agrupar campos por página
@@ -101,34 +164,70 @@ def flatten_template_with_values(template_bytes: bytes, fields: List[Dict]) -> P
         by_page.setdefault(f["page"], []).append(f)
 
     for i, page in enumerate(reader.pages):
-        page_w, page_h = _page_size(page)
-        if i in by_page:
-            overlay = _draw_values_overlay(by_page[i], page_w, page_h)
-            page.merge_page(overlay.pages[0])
-        if "/Annots" in page:
-            page.pop("/Annots")
-        writer.add_page(page)
+        # Sin /Annots: los widgets (y sus /AP) no llegan a copiarse al writer
+        wpage = writer.add_page(page, excluded_keys=("/Annots",))
+        if i not in by_page:
+            continue
+        # El contenido original va entre q/Q para que su estado gráfico no afecte a los textos
+        original = wpage.get_contents()
+        data = b"q\n" + (original.get_data() if original is not None else b"") + b"\nQ\n"
+        content = ContentStream(None, None)
+        content.set_data(data + _values_content_stream(by_page[i]))
+        _ensure_overlay_fonts(wpage)
+        wpage.replace_contents(content)
+        wpage.compress_content_streams()
     return writer
 
-def build_annex_page(image: Image.Image, title: str, logo_img: Image.Image = None) -> bytes:
+def prepare_annex_image(up) -> Optional[Tuple[BytesIO, Tuple[int, int]]]:
     """
-    Genera una página A4 horizontal (PDF) con logo, título (sin extensión) y un párrafo explicativo + la imagen escalada.
-    Devuelve bytes del PDF de una sola página.
+    Decodifica una imagen subida a la resolución del anexo y la recomprime como JPEG.
+    Devuelve (JPEG, tamaño en píxeles) o None si la imagen no se puede leer (se omite sin interrumpir el resto).
+    Al terminar libera la imagen decodificada y el buffer de la subida.
+    """
+    img = None
+    try:
+        img = Image.open(up)
+        # Decodificar directamente a la resolución final (JPEG: escalado DCT en libjpeg)
+        img.draft("RGB", ANNEX_MAX_PX)
+        # thumbnail no sabe remuestrear todos los modos (p. ej. grises de 16 bits, I;16): se pasa antes a RGB,
+        # igual que hacía la conversión original
+        if img.mode != "RGB":
+            with img:
+                img = img.convert("RGB")
+        # Lanczos para un reescalado nítido; reducing_gap hace antes una reducción por bloques (Image.reduce)
+        img.thumbnail(ANNEX_MAX_PX, resample=Image.LANCZOS, reducing_gap=2.0)
+        # Se incrusta como JPEG ya comprimido: ReportLab copia el flujo DCT tal cual en lugar de recomprimir píxeles
+        jpeg = BytesIO()
+        with img.convert("RGB") as rgb:
+            rgb.save(jpeg, "JPEG", quality=85, optimize=True)
+            size = rgb.size
+        jpeg.seek(0)
+        return jpeg, size
+    except Exception:
+        return None
+    finally:
+        if img is not None:
+            img.close()
+        up.close()
+
+def draw_annex_page(c: canvas.Canvas, jpeg: Optional[BytesIO], image_size: Tuple[int, int], title: str,
+                    logo_reader: Optional[ImageReader] = None):
+    """
+    Dibuja en la página actual del canvas un anexo A4 horizontal con logo, título (sin extensión)
+    y un párrafo explicativo + la imagen escalada. No cierra la página (showPage lo hace quien llama).
     """
     width, height = landscape(A4)
     margin = 1.5 * cm
-    buf = BytesIO()
-    c = canvas.Canvas(buf, pagesize=(width, height))
 
     # Logo
-    if logo_img:
+    if logo_reader:
         try:
             # Escala sólida de ~4.5cm de ancho
             lw = 4.5 * cm
-            iw, ih = logo_img.size
+            iw, ih = logo_reader.getSize()
             ratio = lw / iw
             lh = ih * ratio
-            c.drawImage(ImageReader(logo_img), margin, height - margin - lh, width=lw, height=lh, mask='auto')
+            c.drawImage(logo_reader, margin, height - margin - lh, width=lw, height=lh, mask='auto')
         except Exception:
             pass
 
@@ -163,32 +262,118 @@ def build_annex_page(image: Image.Image, title: str, logo_img: Image.Image = Non
     c.setDash()
 
     # Imagen escalada centrada
-    if image:
-        iw, ih = image.size
+    if jpeg:
+        iw, ih = image_size
         scale = min(box_w / iw, box_h / ih)
         dw, dh = iw * scale, ih * scale
         dx = box_x + (box_w - dw) / 2
         dy = box_y + (box_h - dh) / 2
-        c.drawImage(ImageReader(image.convert("RGB")), dx, dy, width=dw, height=dh, mask='auto')
+        # drawImage decodifica el bitmap para calcular su firma y lo guarda en el reader; como ImageReader
+        # forma un ciclo de referencias (jpeg_fh), solo lo liberaría el GC: se suelta aquí, página a página
+        reader = ImageReader(jpeg)
+        try:
+            c.drawImage(reader, dx, dy, width=dw, height=dh)
+        finally:
+            reader._data = None
+            reader._image.close()
 
-    c.showPage()
+def build_annexes_pdf(annexes: List[Tuple[str, BytesIO, Tuple[int, int]]],
+                      logo_reader: Optional[ImageReader] = None) -> BytesIO:
+    """
+    Genera un único PDF multipágina con un anexo por imagen (mismo canvas: el logo se incrusta una sola vez).
+    """
+    buf = BytesIO()
+    c = canvas.Canvas(buf, pagesize=landscape(A4))
+    for title, jpeg, image_size in annexes:
+        draw_annex_page(c, jpeg, image_size, title, logo_reader)
+        c.showPage()
     c.save()
-    return buf.getvalue()
+    buf.seek(0)
+    return buf
 
-def merge_writer_and_annexes(writer: PdfWriter, annex_pdfs: List[bytes]) -> bytes:
+def merge_writer_and_annexes(writer: PdfWriter, annexes_pdf: Optional[BytesIO]) -> BytesIO:
     """
-    Une el PdfWriter (plantilla aplanada) con anexos (cada uno PDF de 1 página). Devuelve bytes del PDF final.
+    Añade al PdfWriter (plantilla aplanada) las páginas del PDF de anexos, parseado una sola vez.
+    Se reutiliza el mismo writer: no se copian de nuevo las páginas de la plantilla.
+    Devuelve el buffer donde se ha serializado el PDF final (st.download_button hace igualmente
+    su propia copia a bytes con getvalue(); devolver el BytesIO no la evita).
     """
-    final = PdfWriter()
-    for p in writer.pages:
-        final.add_page(p)
-    for ap in annex_pdfs:
-        r = PdfReader(BytesIO(ap))
-        for page in r.pages:
-            final.add_page(page)
+    if annexes_pdf is not None:
+        writer.append(PdfReader(annexes_pdf))
     out = BytesIO()
-    final.write(out)
-    return out.getvalue()
+    writer.write(out)
+    out.seek(0)
+    return out
+
+# ------------- Carga de activos (cacheada entre reruns) -------------
+@st.cache_data
+def load_template_bytes() -> bytes:
+    """
+    Lee la plantilla una sola vez por proceso.
+    """
+    with open(TEMPLATE_FILE, "rb") as f:
+        return f.read()
+
+@st.cache_data
+def extract_fields(template_bytes: bytes) -> List[Dict]:
+    """
+    Extrae los campos (widgets texto) de la plantilla: nombre, valor por defecto, página y rectángulo.
+    """
+    reader = PdfReader(BytesIO(template_bytes))
+    fields = []
+    seen = {}  # referencias indirectas ya resueltas: (idnum, generation) -> objeto
+    for page_idx, page in enumerate(reader.pages):
+        annots = page.get("/Annots")
+        if not annots:
+            continue
+        for a in annots.get_object():
+            if isinstance(a, IndirectObject):
+                ref = (a.idnum, a.generation)
+                obj = seen.get(ref)
+                if obj is None:
+                    obj = seen[ref] = a.get_object()
+            else:
+                obj = a
+            name = obj.get("/T")
+            if name is None or obj.get("/Subtype") != "/Widget":
+                continue
+            rect = obj.get("/Rect")
+            val = obj.get("/V")
+            if name and rect:
+                try:
+                    rect_f = [float(x) for x in rect]
+                except Exception:
+                    continue
+                name = str(name).strip("()")
+                font_size, draw_x, draw_y = _field_layout(rect_f)
+                fields.append({
+                    "name": name,
+                    "label": FIELD_TITLES.get(name, name),
+                    "key": f"inp_{name}",
+                    "value": (str(val).strip("()") if val else ""),
+                    "page": page_idx,
+                    "rect": rect_f,
+                    "_font_size": font_size,
+                    "_draw_x": draw_x,
+                    "_draw_y": draw_y,
+                })
+    return fields
+
+@st.cache_resource
+def load_logo() -> Optional[ImageReader]:
+    """
+    Prepara el logo una sola vez por proceso como ImageReader reutilizable en todos los anexos.
+    Devuelve None si no existe o no se puede leer.
+    """
+    if not os.path.exists(LOGO_FILE):
+        return None
+    try:
+        with open(LOGO_FILE, "rb") as f:
+            logo_reader = ImageReader(BytesIO(f.read()))
+        logo_reader.getRGBData()  # decodifica ya: la instancia se comparte entre sesiones
+        return logo_reader
+    except Exception:
+        return None
 
 # ------------- App Streamlit -------------
 st.set_page_config(page_title=APP_TITLE, page_icon="🦾", layout="wide")
@@ -200,84 +385,63 @@ if not os.path.exists(TEMPLATE_FILE):
     st.stop()
 if not os.path.exists(LOGO_FILE):
     st.warning("⚠️ No se encontró logo.png en assets/. Se generarán anexos sin logo.")
-    logo_img = None
-else:
-    try:
-        logo_img = Image.open(LOGO_FILE)
-    except Exception:
-        logo_img = None
+logo_reader = load_logo()
 
 # Leemos campos de la plantilla
-with open(TEMPLATE_FILE, "rb") as f:
-    template_bytes = f.read()
-reader = PdfReader(BytesIO(template_bytes))
-
-# Extraer campos (widgets texto) y montarlos en UI
-fields = []
-for page_idx, page in enumerate(reader.pages):
-    annots = page.get("/Annots")
-    if not annots:
-        continue
-    for a in annots:
-        obj = a.get_object()
-        if obj.get("/Subtype") != "/Widget":
-            continue
-        name = obj.get("/T")
-        rect = obj.get("/Rect")
-        val = obj.get("/V")
-        if name and rect:
-            try:
-                rect_f = [float(x) for x in rect]
-            except Exception:
-                continue
-            fields.append({
-                "name": str(name).strip("()"),
-                "value": (str(val).strip("()") if val else ""),
-                "page": page_idx,
-                "rect": rect_f
-            })
-
-st.markdown("### 1) Rellena los datos del plan")
-cols = st.columns(2)
-left, right = cols[0], cols[1]
-
-# Mostramos entradas (mitad-izquierda y mitad-derecha alternando)
-ui_values: Dict[str, str] = {}
-for idx, f in enumerate(fields):
-    label = FIELD_TITLES.get(f["name"], f["name"])
-    default = f.get("value", "")
-    target = left if idx % 2 == 0 else right
-    ui_values[f["name"]] = target.text_input(label, value=default, key=f"inp_{f['name']}")
-
-st.markdown("---")
-st.markdown("### 2) Adjunta imágenes (cada imagen será un anexo)")
-images_up = st.file_uploader("Imágenes (PNG, JPG, JPEG, BMP, TIFF)", type=["png", "jpg", "jpeg", "bmp", "tif", "tiff"], accept_multiple_files=True)
-
-# Botón generar
-st.markdown("---")
-if st.button("🧾 Generar PDF Final"):
+template_bytes = load_template_bytes()
+fields = extract_fields(template_bytes)
+
+# Todo el formulario va dentro de st.form: escribir en los campos no provoca reruns hasta pulsar "Generar"
+with st.form("plan_form"):
+    st.markdown("### 1) Rellena los datos del plan")
+    cols = st.columns(2)
+    left, right = cols[0], cols[1]
+
+    # Mostramos entradas (mitad-izquierda y mitad-derecha alternando)
+    ui_values: Dict[str, str] = {}
+    for idx, f in enumerate(fields):
+        target = left if idx % 2 == 0 else right
+        ui_values[f["name"]] = target.text_input(f["label"], value=f["value"], key=f["key"])
+
+    st.markdown("---")
+    st.markdown("### 2) Adjunta imágenes (cada imagen será un anexo)")
+    images_up = st.file_uploader("Imágenes (PNG, JPG, JPEG, BMP, TIFF)", type=["png", "jpg", "jpeg", "bmp", "tif", "tiff"], accept_multiple_files=True)
+
+    # Botón generar
+    st.markdown("---")
+    generar = st.form_submit_button("🧾 Generar PDF Final")
+
+# La descarga queda fuera del formulario (st.download_button no se admite dentro de st.form)
+if generar:
     try:
         # Inyectar valores en la estructura de campos
         for f in fields:
             f["value"] = ui_values.get(f["name"], "")
 
         # Aplanar plantilla con valores
-        writer = flatten_template_with_values(template_bytes, fields)
-
-        # Crear anexos (solo para las imágenes adjuntas)
-        annex_pdfs: List[bytes] = []
-        for up in images_up or []:
-            try:
-                img = Image.open(up).convert("RGB")
-                annex_pdf = build_annex_page(img, up.name, logo_img)
-                annex_pdfs.append(annex_pdf)
-            except Exception:
-                pass
+        # Un único parseo de la plantilla por generación (PdfReader lee su flujo de forma perezosa,
+        # así que no se comparte una instancia entre sesiones concurrentes)
+        writer = flatten_template_with_values(PdfReader(BytesIO(template_bytes)), fields)
+
+        # Crear anexos (solo para las imágenes adjuntas): decodificación y JPEG en paralelo
+        # (PIL/zlib liberan el GIL); el dibujo va en serie sobre un único canvas
+        uploads = images_up or []
+        annexes_pdf = None
+        if uploads:
+            with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as ex:
+                annex_images = list(ex.map(lambda up: (up.name, prepare_annex_image(up)), uploads))
+            annexes = [(name, *image) for name, image in annex_images if image is not None]
+            if annexes:
+                annexes_pdf = build_annexes_pdf(annexes, logo_reader)
 
         # Unir y ofrecer descarga
-        final_bytes = merge_writer_and_annexes(writer, annex_pdfs)
+        final_pdf = merge_writer_and_annexes(writer, annexes_pdf)
+        # Liberar writer y anexos antes de la descarga (Streamlit aún copia final_pdf a bytes con getvalue()).
+        # PdfWriter queda en ciclos de referencias (sus IndirectObject apuntan a él): sin gc.collect() el del no libera nada
+        del writer, annexes_pdf
+        gc.collect()
         filename = f"Plan_Izado_ESPAGRUAS_{datetime.now().strftime('%Y%m%d_%H%M')}.pdf"
         st.success("✅ PDF final generado correctamente.")
-        st.download_button("⬇️ Descargar PDF", data=final_bytes, file_name=filename, mime="application/pdf")
+        st.download_button("⬇️ Descargar PDF", data=final_pdf, file_name=filename, mime="application/pdf")
     except Exception as e:
         st.error(f"❌ No se pudo generar el PDF final.\n\n{e}")